@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv, set_key
 from openai import OpenAI
 from typing import List, Optional, Union
@@ -6,12 +7,56 @@ import inspect
 import sys
 import importlib.util
 import ast
+import json
+import re
 import subprocess
 import hashlib
 
 from . import copilation_errors as errors
 from . import system_messages as sm
 
+# formatting in-process avoids forking a fresh interpreter per copilation; fall back to the
+# command-line tools if the libraries are not importable
+try:
+    import isort
+    import black
+except ImportError:
+    isort = None
+    black = None
+
+# blake3 is SIMD-parallel and several times faster than sha256 on large inputs; fall back
+# to hashlib when it is not installed
+try:
+    from blake3 import blake3 as _blake3
+except ImportError:
+    _blake3 = None
+
+# tiktoken gives an exact token count for the pre-flight budget check; fall back to a
+# character heuristic when it is not installed
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+_client = None
+_env_loaded = False
+
+def _get_client():
+    """
+    Lazily create a single shared OpenAI client.
+
+    Loading the dotenv file and building a client (with its underlying HTTP connection pool)
+    only happens once, so repeated completions reuse the same connection instead of paying
+    for a new TLS handshake on every call.
+    """
+    global _client, _env_loaded
+    if not _env_loaded:
+        load_dotenv()
+        _env_loaded = True
+    if _client is None:
+        _client = OpenAI()
+    return _client
+
 def _save_api_key(api_key: str):
     """
     Save an OPENAI_API_KEY key in a dotenv file.
@@ -23,16 +68,41 @@ def _save_api_key(api_key: str):
         api_key (str): The API key to be saved.
 
     """
+    global _client, _env_loaded
     dotenv_path = '.env'
     load_dotenv(dotenv_path)
     set_key(dotenv_path, "OPENAI_API_KEY", api_key)
 
+    # drop the cached client so the new key takes effect on the next completion
+    _client = None
+    _env_loaded = False
+
+
+_completion_cache_dir = './copilations/.completion_cache'
+
+def _completion_cache_path(model:str, system_message:str, comment:str) -> str:
+    key = hashlib.sha256((model + system_message + comment).encode()).hexdigest()
+    return os.path.join(_completion_cache_dir, f'{key}.txt')
+
 
-def _get_completion(comment:str, system_message:str, model_class:str='fast', temperature:float=0):
-    load_dotenv()
+_encoders = {}
 
-    client = OpenAI()
+def _count_tokens(text:str, model:str) -> Optional[int]:
+    """
+    Count the tokens in a text with the model's tokenizer, or return None if no tokenizer
+    is available. Encoders take ~50ms to build (and may need a network fetch), so cache one
+    per model — including the failure, so an offline machine does not retry every call.
+    """
+    if model not in _encoders:
+        try:
+            _encoders[model] = tiktoken.encoding_for_model(model) if tiktoken else None
+        except Exception:
+            _encoders[model] = None
+    encoder = _encoders[model]
+    return len(encoder.encode(text)) if encoder else None
 
+
+def _get_completion(comment:str, system_message:str, model_class:str='fast', temperature:float=0, cache:bool=True):
     models = {'fast': 'gpt-4o-mini',
               'best': 'gpt-4o'}
     
@@ -44,11 +114,28 @@ def _get_completion(comment:str, system_message:str, model_class:str='fast', tem
 
     model = models[model_class]
 
-    max_characters = int(model_max_tokens[model] * 0.9 * 4) #90% of max to allow for some deviation from the nominal 4 characters/token 
-    if len(comment) > max_characters:
-        completion = f'Could not get a completion because the number of characters ({len(comment)}) exceeds the max allowed ({max_characters}).'
+    # identical inputs give identical completions at temperature 0, so reuse any response
+    # cached on disk from a previous call or run and skip the API entirely
+    cache_path = _completion_cache_path(model, system_message, comment)
+    if cache and os.path.isfile(cache_path):
+        with open(cache_path, 'r') as file:
+            return file.read()
+
+    # pre-flight budget check: catch an over-limit request before paying for the round-trip
+    max_tokens = int(model_max_tokens[model] * 0.9) #90% of max to leave some headroom
+    n_tokens = _count_tokens(comment, model)
+    if n_tokens is not None:
+        if n_tokens > max_tokens:
+            return f'Could not get a completion because the number of tokens ({n_tokens}) exceeds the max allowed ({max_tokens}).'
     else:
-        completion = client.chat.completions.create(
+        # no tokenizer available: bound by UTF-8 bytes at the nominal 4 bytes/token; the
+        # character count is a lower bound on bytes, so check it first to skip the encode
+        max_bytes = max_tokens * 4
+        if len(comment) > max_bytes or len(comment.encode('utf-8')) > max_bytes:
+            return f'Could not get a completion because the number of bytes ({len(comment.encode("utf-8"))}) exceeds the max allowed ({max_bytes}).'
+
+    client = _get_client()
+    completion = client.chat.completions.create(
                                                     model=model,
                                                     temperature=temperature,
                                                     messages=[
@@ -56,48 +143,83 @@ def _get_completion(comment:str, system_message:str, model_class:str='fast', tem
                                                         {"role": "user", "content": comment}
                                                     ],
                                                     )
-    return completion.choices[0].message.content
+    response = completion.choices[0].message.content
+
+    # always refresh the cache with a fresh response, so cache=False reruns do not leave stale entries
+    os.makedirs(_completion_cache_dir, exist_ok=True)
+    temp_path = f'{cache_path}.tmp'
+    with open(temp_path, 'w') as file:
+        file.write(response)
+    os.replace(temp_path, cache_path)  # atomic, so a concurrent reader never sees a partial file
 
+    return response
 
-def _strip_special(s:str, prefixes:Optional[List[str]]=[], suffixes:Optional[List[str]]=[]) -> str:
-    for prefix in prefixes:
-        if s.startswith(prefix):
-            s = s[len(prefix):]
-    for suffix in suffixes:
-        if s.endswith(suffix):
-            s = s[:-len(suffix)]
-    return s
 
+# strips the decorations gpt can wrap around a response — a stray quote and/or a code
+# fence (optionally tagged python or json) — in one C-level scan
+_clean_response_re = re.compile(r"^\s*(?:'\s*)?(?:```(?:python|json)?)?\s*(.*?)\s*(?:```)?\s*(?:')?\s*$", re.DOTALL)
 
 def _clean_response(response):
     # Clean up the response. Gpt can add unwanted decorators and things.
-    prefixes = ["'", "```python", "```json"]
-    suffixes = ["'", "```"]
-    return _strip_special(response, prefixes, suffixes).strip()
+    return _clean_response_re.match(response).group(1)
 
 
-def _parse_callable_name(source_code):
-    tree = ast.parse(source_code)
+# the node types a copiled callable can be defined as
+_def_node_types = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+
+def _find_def_node(tree:ast.AST, callable_name:str):
+    """
+    Find the def or class node with the given name in a parsed tree, or None.
+    """
     for node in ast.walk(tree):
-        if isinstance(node, ast.FunctionDef) or isinstance(node, ast.ClassDef):
-            return node.name
+        if isinstance(node, _def_node_types) and node.name == callable_name:
+            return node
     return None
 
-def _get_existing_copilation(copilation_filename:str, callable_name:str):
-    spec = importlib.util.spec_from_file_location('test_module_name', copilation_filename)
-    module = importlib.util.module_from_spec(spec)
 
+def _parse_callable_name(source_code:Union[str, ast.AST]):
+    tree = source_code if isinstance(source_code, ast.AST) else ast.parse(source_code)
+    for node in ast.walk(tree):
+        if isinstance(node, _def_node_types):
+            return node.name
+    return None
+
+def _copilation_exists(copilation_filename:str, callable_name:str) -> bool:
+    """
+    Check whether the copilations file defines the named callable, by scanning its AST
+    rather than executing it.
+    """
     try:
+        with open(copilation_filename, 'r') as file:
+            tree = ast.parse(file.read())
+    except (FileNotFoundError, SyntaxError):
+        return False
+    return _find_def_node(tree, callable_name) is not None
+
+
+_loaded_modules = {}
+
+def _load_copilation(copilation_filename:str, callable_name:str):
+    """
+    Import the copilations file and return the named callable from it.
+
+    Modules are memoized per file path, so repeated loads are a dict lookup, and importing
+    the written file (rather than exec'ing the source string) lets Python's bytecode cache
+    skip reparsing on subsequent runs.
+    """
+    path = os.path.abspath(copilation_filename)
+    module = _loaded_modules.get(path)
+    if module is None:
+        spec = importlib.util.spec_from_file_location(callable_name, copilation_filename)
+        module = importlib.util.module_from_spec(spec)
         spec.loader.exec_module(module)
-    except FileNotFoundError:
-        return None
-    try:
-        return getattr(module, callable_name)
-    except AttributeError:
-        return None
+        _loaded_modules[path] = module
+    return getattr(module, callable_name)
 
 
 def _move_imports_to_top(file_path):
+    # isort only sorts imports where they sit, so imports emitted below earlier code still
+    # need hoisting; classify each line once against a tuple of prefixes and write in one go
     with open(file_path, 'r') as f:
         lines = f.readlines()
 
@@ -105,39 +227,44 @@ def _move_imports_to_top(file_path):
     others = []
 
     for line in lines:
-        if line.strip().startswith('import ') or line.strip().startswith('from '):
+        if line.lstrip().startswith(('import ', 'from ')):
             imports.append(line.strip() + '\n')
         else:
             others.append(line)
 
     with open(file_path, 'w') as f:
-        f.writelines(imports)
-        f.writelines(others)
+        f.write(''.join(imports) + ''.join(others))
 
 
 def _rewrite_copiled_source(copilation_filename:str, callable_name:str, new_source_code):
     """
     Overwrite the original copiled source code with the new source code.
+
+    The file is located and spliced with a single ast.parse rather than being executed as a
+    module, so overwriting never runs the existing copiled code.
     """
-    spec = importlib.util.spec_from_file_location("copile", copilation_filename)
-    module = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(module)
-    source_code = inspect.getsource(getattr(module, callable_name))
-    with open(copilation_filename, "r+") as file:
-        lines = file.readlines()
-        function_start_line = inspect.getsourcelines(getattr(module, callable_name))[1]
-        function_end_line = function_start_line + len(source_code.split('\n'))
-        lines[function_start_line - 1:function_end_line] = new_source_code + '\n\n\n'
-        file.seek(0)
+    with open(copilation_filename, 'r') as file:
+        file_source = file.read()
+
+    tree = ast.parse(file_source)
+    node = _find_def_node(tree, callable_name)
+    if node is None:
+        return
+
+    # node.lineno points at the def itself; any decorators sit above it and belong to the
+    # same definition, so start the splice at the first decorator
+    start_line = node.decorator_list[0].lineno if node.decorator_list else node.lineno
+    lines = file_source.splitlines(keepends=True)
+    lines[start_line - 1:node.end_lineno] = [new_source_code + '\n\n\n']
+    with open(copilation_filename, 'w') as file:
         file.writelines(lines)
-        file.truncate()        
 
 
 def _write_copiled_source(copilation_filename:str, callable_name:str, source_code:str):
     """
     Write the copiled source code to file.
     """
-    if _get_existing_copilation(copilation_filename, callable_name):
+    if _copilation_exists(copilation_filename, callable_name):
         _rewrite_copiled_source(copilation_filename, callable_name, source_code)
     else:
         with open(copilation_filename, 'a+') as file:
@@ -145,20 +272,25 @@ def _write_copiled_source(copilation_filename:str, callable_name:str, source_cod
 
     # move imports to top of file
     _move_imports_to_top(copilation_filename)
-    subprocess.run(["isort", "--quiet", copilation_filename])
-    subprocess.run(["black", "--quiet", copilation_filename])
-
+    if isort is not None and black is not None:
+        with open(copilation_filename, 'r') as file:
+            source = file.read()
+        source = isort.code(source)
+        source = black.format_str(source, mode=black.Mode())
+        with open(copilation_filename, 'w') as file:
+            file.write(source)
+    else:
+        subprocess.run(["isort", "--quiet", copilation_filename])
+        subprocess.run(["black", "--quiet", copilation_filename])
 
-def _get_calling_filename(func):
-    path = inspect.getfile(func)
-    return os.path.basename(path)
+    # the file changed on disk, so drop any memoized module for it
+    _loaded_modules.pop(os.path.abspath(copilation_filename), None)
 
 
-def _source_to_object(source:str):
-    source_name = _parse_callable_name(source)
-    globals_dict = {}
-    exec(source, globals_dict)
-    return globals_dict[source_name]
+def _get_calling_filename(func):
+    # a direct attribute lookup; inspect.getfile gets there too, but only after a chain of
+    # type checks and a sys.modules walk
+    return os.path.basename(func.__code__.co_filename)
 
 
 def load_list(filename: str) -> list[str]:
@@ -172,8 +304,16 @@ def load_list(filename: str) -> list[str]:
         list[str]: A list of strings read from the file.
     """
     with open(filename, 'r') as file:
-        return file.read().splitlines()
+        return [line.rstrip('\n') for line in file if line.strip()]
+
 
+# the blacklist files ship with the package and never change within a run, so load them once
+_module_dir = os.path.dirname(__file__)
+_module_blacklist = frozenset(load_list(os.path.join(_module_dir, 'module_blacklist.txt')))
+_function_blacklist = frozenset(load_list(os.path.join(_module_dir, 'function_blacklist.txt')))
+
+# matches the top-level module name of 'import x', 'import x.y', and 'from x.y import z' statements
+_import_re = re.compile(r'^\s*(?:import|from)\s+(\w+)', re.M)
 
 def check_for_blacklisted_modules_used(source_code: str, blacklist: List[str]) -> Optional[List[str]]:
     """
@@ -186,58 +326,89 @@ def check_for_blacklisted_modules_used(source_code: str, blacklist: List[str]) -
     Returns:
         Optional[List[str]]: A list of all blacklisted modules used, or None if none are used.
     """
-    used_modules = []
-    for module in blacklist:
-        if f"import {module}" in source_code or f"from {module} import" in source_code:
-            used_modules.append(module)
-    return used_modules
+    imported_modules = set(match.group(1) for match in _import_re.finditer(source_code))
+    return list(imported_modules & set(blacklist))
 
-def check_for_blacklisted_functions_used(source: str, blacklisted_functions: List[str]) -> List[str]:
+def check_for_blacklisted_functions_used(source: str, blacklisted_functions: List[str], tree: Optional[ast.AST]=None) -> List[str]:
     """
     Checks the source code for any usage of blacklisted functions and returns their names.
 
     Args:
         source: A string containing the source code to be checked.
         blacklisted_functions: A set of strings representing the names of functions that are blacklisted.
+        tree: An already-parsed AST of the source, to avoid reparsing.
 
     Returns:
         A list of strings representing the names of blacklisted functions that are used in the source code.
     """
 
-    # Helper function to recursively find function calls
-    def find_function_calls(node, found):
-        for child in ast.iter_child_nodes(node):
-            if isinstance(child, ast.Call) and isinstance(child.func, ast.Name):
-                if child.func.id in blacklisted_functions:
-                    found.add(child.func.id)
-            find_function_calls(child, found)
-
     # Parse the source code into an AST
-    tree = ast.parse(source)
-    found_blacklisted_functions = set()
-    find_function_calls(tree, found_blacklisted_functions)
+    if tree is None:
+        tree = ast.parse(source)
+
+    blacklisted_functions = set(blacklisted_functions)
+    found_blacklisted_functions = {node.func.id for node in ast.walk(tree)
+                                   if isinstance(node, ast.Call)
+                                   and isinstance(node.func, ast.Name)
+                                   and node.func.id in blacklisted_functions}
 
     return list(found_blacklisted_functions)
 
-def _review_safety(source:str, module_whitelist=[], function_whitelist=[], unsafe_overrides=[]):
+def _check_blacklists(source:str, module_whitelist=[], function_whitelist=[], tree:Optional[ast.AST]=None):
 
     # check for imports of blacklisted modules
-    module_dir = os.path.dirname(__file__)
-    file_path = os.path.join(module_dir, 'module_blacklist.txt')
-    module_blacklist = list(set(load_list(file_path)) - set(module_whitelist))
+    module_blacklist = _module_blacklist - set(module_whitelist)
     used_blacklisted_modules = check_for_blacklisted_modules_used(source, module_blacklist)
     if used_blacklisted_modules:
         raise errors.BlackListedModuleImportError(source, used_blacklisted_modules)
-    
+
     # check for use of blacklisted functions
-    module_dir = os.path.dirname(__file__)
-    file_path = os.path.join(module_dir, 'function_blacklist.txt')
-    function_blacklist = list(set(load_list(file_path)) - set(function_whitelist))
-    used_blacklisted_functions = check_for_blacklisted_functions_used(source, function_blacklist)
+    function_blacklist = _function_blacklist - set(function_whitelist)
+    used_blacklisted_functions = check_for_blacklisted_functions_used(source, function_blacklist, tree=tree)
     if used_blacklisted_functions:
         raise errors.BlackListedFunctionUseError(source, used_blacklisted_functions)
-    
-    # have gpt review source code for unsafe activites  
+
+def _review_combined(callable_name:str, specification:str, source:str, module_whitelist=[], function_whitelist=[], unsafe_overrides=[], tree:Optional[ast.AST]=None):
+    """
+    Review the specification for clarity and the copiled source for safety in a single gpt round-trip.
+    """
+    _check_blacklists(source, module_whitelist=module_whitelist, function_whitelist=function_whitelist, tree=tree)
+
+    # have gpt review the specification and source together
+    specification_and_source = f'SPECIFICATION:\n{specification}\n\nSOURCE:\n{source}'
+    verdict = _get_completion(specification_and_source, sm.combined_review, model_class='best')
+    try:
+        verdict = json.loads(_clean_response(verdict))
+        if not (isinstance(verdict['spec'], str)
+                and isinstance(verdict['safety'], list)
+                and all(isinstance(issue, str) for issue in verdict['safety'])):
+            raise TypeError('verdict fields have the wrong types')
+    except (json.JSONDecodeError, KeyError, TypeError):
+        # the reviewer strayed from the JSON verdict format; fall back to the two
+        # single-purpose reviews, run concurrently since they are independent network calls
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            specification_review = executor.submit(_review_specification, callable_name, specification)
+            safety_review = executor.submit(_review_safety, source,
+                                            module_whitelist=module_whitelist,
+                                            function_whitelist=function_whitelist,
+                                            unsafe_overrides=unsafe_overrides)
+            specification_review.result()
+            safety_review.result()
+        return
+
+    if verdict['spec'].startswith('UNCLEAR'):
+        raise errors.SpecificationUnclearError(callable_name, verdict['spec'])
+
+    issues = set(verdict['safety'])
+    issues = issues - set(unsafe_overrides)
+    issues = issues - {'NONE'}
+    if issues:
+        raise errors.CopiledSourceDeemedUnsafeError(source, issues)
+
+def _review_safety(source:str, module_whitelist=[], function_whitelist=[], unsafe_overrides=[]):
+    _check_blacklists(source, module_whitelist=module_whitelist, function_whitelist=function_whitelist)
+
+    # have gpt review source code for unsafe activites
     issues = _get_completion(source, sm.check_for_safety_issues, model_class='best')
     issues = set(issues.split(', '))
     issues = issues - set(unsafe_overrides)
@@ -271,31 +442,55 @@ def _copiler(func, force_copilation=False, module_whitelist:Union[str,List[str]]
         if not os.path.isdir('copilations'):
             os.makedirs('copilations', exist_ok=True)
 
-        existing_copilation = _get_existing_copilation(copilations_filename, callable_name)
+        existing_copilation = _copilation_exists(copilations_filename, callable_name)
+
+        # an unchanged specification copiles to the same source at temperature 0, so if the
+        # stored specification hash matches, reuse the existing copilation and skip the
+        # generation and review round-trips entirely (even under force_copilation)
+        specification_hash = hashlib.sha256(specification.encode()).hexdigest()
+        spec_hash_filename = f'{copilations_filename}.hash'
+        if existing_copilation:
+            try:
+                with open(spec_hash_filename, 'r') as file:
+                    if file.read() == specification_hash:
+                        try:
+                            return _load_copilation(copilations_filename, callable_name)
+                        except ModuleNotFoundError as e:
+                            raise errors.CopiledSourceCodeNeedsModule(e.name) from None
+            except FileNotFoundError:
+                pass
 
         if force_copilation or not existing_copilation:
 
-            _review_specification(callable_name, specification)
-
             max_tries = 2
             tries = 0
             stop_trying = False
             model_class = 'best'
             while tries < max_tries and not stop_trying:
                 copiled_source = f'def {callable_name}(me):\n    return me\n'
-                copiled_source = _get_completion(specification, sm.copile_from_specification, model_class=model_class)
+                # bypass the cache when the user forces recopilation or when retrying after a bad response
+                use_cache = not force_copilation and tries == 0
+                copiled_source = _get_completion(specification, sm.copile_from_specification, model_class=model_class, cache=use_cache)
                 copiled_source = _clean_response(copiled_source)
 
                 # if copiled_source.startswith('ERROR'):
                 #     raise errors.SpecificationUnclearError(callable_name, copiled_source.removeprefix('ERROR: '))
-                
-                _review_safety(copiled_source,
-                               module_whitelist=module_whitelist,
-                               function_whitelist=function_whitelist,
-                               unsafe_overrides=unsafe_overrides) # will assert if source is deemed unsafe
+
+                # parse once and share the tree with the reviews below
+                copiled_tree = ast.parse(copiled_source)
+
+                _review_combined(callable_name,
+                                 specification,
+                                 copiled_source,
+                                 module_whitelist=module_whitelist,
+                                 function_whitelist=function_whitelist,
+                                 unsafe_overrides=unsafe_overrides,
+                                 tree=copiled_tree) # will assert if the spec is unclear or source is deemed unsafe
                 try:
-                    func = _source_to_object(copiled_source)
                     _write_copiled_source(copilations_filename, callable_name, copiled_source)
+                    func = _load_copilation(copilations_filename, callable_name)
+                    with open(spec_hash_filename, 'w') as file:
+                        file.write(specification_hash)
                     print(f"The specification for '{callable_name}()' was copiled in {copilations_filename}")
                     return func
                 except ModuleNotFoundError as e:
@@ -309,7 +504,10 @@ def _copiler(func, force_copilation=False, module_whitelist:Union[str,List[str]]
             return None
         
         else:
-            return existing_copilation
+            try:
+                return _load_copilation(copilations_filename, callable_name)
+            except ModuleNotFoundError as e:
+                raise errors.CopiledSourceCodeNeedsModule(e.name) from None
 
 def copile(*args, force_copilation=False, module_whitelist:Union[str,List[str]]=[], function_whitelist:Union[str,List[str]]=[], unsafe_overrides:Union[str,List[str]]=[]):
     if len(args) == 1 and callable(args[0]):
@@ -325,27 +523,29 @@ def copile(*args, force_copilation=False, module_whitelist:Union[str,List[str]]=
                                     unsafe_overrides=unsafe_overrides,
                                     )
 
-def save_hash_to_file(string: str, filename: str) -> None:
+def save_hash_to_file(string: Union[str, bytes], filename: str) -> None:
     """Hashes a given string and saves the hash to a specified file.
 
     Args:
-        string (str): The string to be hashed.
+        string (Union[str, bytes]): The string (or already-encoded bytes) to be hashed.
         filename (str): The name of the file where the hash will be saved.
     """
-    
-    def hash_string(s: str) -> str:
-        """Generates a SHA-256 hash of the input string.
+
+    def hash_string(s: Union[str, bytes]) -> str:
+        """Generates a blake3 (or SHA-256, if blake3 is unavailable) hash of the input.
 
         Args:
-            s (str): The string to hash.
+            s (Union[str, bytes]): The data to hash. Bytes are hashed as-is, skipping the encode copy.
 
         Returns:
             str: The hexadecimal representation of the hash.
         """
-        return hashlib.sha256(s.encode()).hexdigest()
+        data = s if isinstance(s, bytes) else s.encode()
+        hasher = _blake3 if _blake3 is not None else hashlib.sha256
+        return hasher(data).hexdigest()
 
     hash_value = hash_string(string)
-    
+
     with open(filename, 'w') as file:
         file.write(hash_value)
 
@@ -3,6 +3,8 @@ Add type hints to the function prototype if any are missing.
 If the docstring is not in Google style, rewrite it in Google style.
 If any modules need to be imported, import them above the function implementation. Don't forget to import types.
 Return only one function. Define any needed helper functions inside the main function.
+If the function performs numeric work over arrays, use numpy vectorized operations. Never use Python-level loops over numpy arrays.
+If the function is a scalar numeric hot loop, import njit from numba and decorate the function with @njit(cache=True) so the compiled code is cached to disk.
 Return only a code block with no other discussion and no examples.
 '''
 
@@ -15,6 +17,20 @@ If the docstring is not in Google style, rewrite it in Google style.
 If any modules need to be imported, import them above the function implementation.
 Return only a code block with no other discussion.'''
 
+combined_review = '''You will be given a python function specification (a prototype and docstring) under the heading SPECIFICATION, and an implementation of it under the heading SOURCE. You must review both and reply with just a JSON object with two keys:
+"spec": If the described behavior of the specification is unclear, ambiguous, or nonsensical, the value must be 'UNCLEAR: <explanation of what is unclear>'. If you could, in good faith, figure out what is intended, the value must be 'CLEAR'.
+"safety": A list of any of the following issues identified in the SOURCE:
+FILE_ACCESS: The code opens or accesses a file.
+FILE_DELETION: The code deletes a file.
+FILE_WRITE: The code creates or writes to a file.
+NON_TERMINATING: The code contains an non-terminating process such as an infinite loop.
+CODE_EVAL: The code tries to evaluate source code.
+SYSTEM_CALL: The code makes a system call or otherwise tries to run any external software.
+GENERALLY_UNSAFE: The code tries to do anything else that might be deemed unsafe.
+If none of these issues are present in the code, the list must be empty.
+Return only the JSON object with no other discussion.
+'''
+
 check_for_safety_issues = '''Given a python function, you must review it for the following issues and reply with a comma-separated list of the identified issues:
 FILE_ACCESS: The code opens or accesses a file.
 FILE_DELETION: The code deletes a file.